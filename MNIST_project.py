@@ -7,16 +7,19 @@
 #
 # Description:  A multi-layered convolutional layer is created,
 #				using relu Activation and maxpooling. 
+#				The inner 3 x 3 convolutions are depthwise-separable
+#				(a depthwise 3 x 3 conv followed by a pointwise 1 x 1 conv).
 #				A dropout function is used between the layers.
 #				Flatten is used to convert the pooled feature maps to a single column 
 #               this is then inputted into 2 dense layers.
 #				Following, the output is given to a softmax activtion 
 #				where the outcome is used for
-#				backpropagtion and one hot encoding the labels.
+#				backpropagtion against the integer class labels.
 #
-# Inputs: 		Keras MNIST Dataset --> Convolutional()-->maxpool-->
-#				Convolutional() --> dropout--> maxpool--> Flatten --> 
-#				Dense(hidden)--> Dropout--> Dense(output).
+# Inputs: 		Keras MNIST Dataset --> Rescaling--> Convolutional(3x3)-->
+#				Separable(3x3)--> Convolutional(5x5)--> maxpool--> dropout-->
+#				2 x Separable(3x3)--> Convolutional(5x5)--> maxpool--> dropout-->
+#				Flatten --> Dense(hidden)--> Dropout--> Dense(output).
 #
 ##########################################################################
 
@@ -24,20 +27,65 @@
 EPOCHS  = 20   # Training run parameters.
 SPLIT   = 0.1  # (90% training, 10% validation.) 
 SHUFFLE = True # Random shuffle on each epoch of train/val samples.
-BATCH   = 32   # Batch size (note Keras default is 32).
-OPT = 'adam'   # Adam optimizer
-
+BATCH   = 256  # Batch size per replica (note Keras default is 32).
+LR      = 0.001*(BATCH/32)**0.5 # Adam learning rate per replica (Keras default,
+                                # square-root scaled up from a batch of 32).
+PATIENCE = 5   # Epochs without val_loss improvement before stopping early.
+STEPS   = 50   # Train steps run per call into the compiled graph.
+RECORD  = 'mnist_train_{}.tfrecord' # uint8 copy of the training set ({} = number of
+                                     # images), written on first run.
+
+
+# Let cuDNN benchmark its Conv2D algorithms (and allow the fastest,
+# non-deterministic ones), and let float32 convs use the tensor cores.
+# These have to be set before Tensorflow is imported.
+import os
+os.environ['TF_CUDNN_USE_AUTOTUNE'] = '1'
+os.environ['TF_CUDNN_DETERMINISTIC'] = '0'
+os.environ['TF_ENABLE_CUDNN_TENSOR_OP_MATH_FP32'] = '1'
 
 # Import the relevant Keras library modules into the IPython notebook.
 import tensorflow
 tensorflow.random.set_seed(2)         # and the seed of the Tensorflow backend.
 
-from tensorflow.keras.utils import to_categorical # for one hot encoding 
+# float32 layers run their convolutions and matmuls in TensorFloat-32 on
+# Ampere tensor cores (no effect on older GPUs or the CPU).
+tensorflow.config.experimental.enable_tensor_float_32_execution(True)
+tensorflow.keras.backend.set_floatx('float32')
+
 from tensorflow.keras import optimizers # Network updates based on loss function
+from tensorflow.keras import mixed_precision # bfloat16 compute, float32 variables
 from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Activation, Flatten, Dropout
+from tensorflow.keras.layers import Dense, Activation, Flatten, Dropout, Rescaling
 from tensorflow.keras.layers import Conv2D, MaxPooling2D, BatchNormalization
-print(tensorflow.__version__)    # Should be at least 2.0.
+from tensorflow.keras.layers import DepthwiseConv2D
+print(tensorflow.__version__)    # Should be at least 2.8 (Rescaling, mixed precision policies,
+                                 # compile(jit_compile=...)).
+
+# Lowest compute capability across the visible GPUs ((0, 0) if there are
+# none), used to pick the fastest numerics the hardware supports.
+gpus = tensorflow.config.list_physical_devices('GPU')
+compute_capability = min((tensorflow.config.experimental.get_device_details(gpu)
+                          .get('compute_capability', (0, 0)) for gpu in gpus),
+                         default=(0, 0))
+print(len(gpus), "GPU(s), compute capability", compute_capability)
+
+# Pre-Ampere GPUs running float32 convs are fastest with cuDNN's native
+# channels_first (NCHW) layout, which avoids a transpose around every conv.
+# Ampere+ (bfloat16 on tensor cores) and the CPU prefer channels_last.
+channels_first = bool(gpus) and compute_capability < (8, 0)
+if channels_first:
+    tensorflow.keras.backend.set_image_data_format('channels_first')
+CHANNEL_AXIS = 1 if channels_first else -1   # Channel axis of an image batch.
+
+# Data-parallel training: the model is replicated on every local GPU and
+# the gradients are all-reduced each step.  The global batch and the
+# learning rate are scaled linearly with the number of replicas.  For
+# several machines use tensorflow.distribute.MultiWorkerMirroredStrategy.
+strategy = tensorflow.distribute.MirroredStrategy()
+replicas = strategy.num_replicas_in_sync
+global_batch = BATCH*replicas
+print(replicas, "replica(s), global batch size", global_batch)
 
 
 import numpy as np
@@ -67,43 +115,114 @@ print("\n First 1000 training labels: \n", training_labels[:1000])
 print("\n First 1000 testing labels: \n", testing_labels[:1000])    
 
 
-# The inputs to the network need to be normalised 'float32' 
-# values, in a tensor of shape (N,28,28,1).  N is the number of 
+# The inputs to the network are the raw uint8 pixel values, in a 
+# tensor of shape (N,28,28,1); the first layer of the model casts 
+# and normalises them on the device.  N is the number of 
 # images, each one with 28 rows and 28 columns, and one channel.  
 # 
 # A greyscale image has one channel (normally implicit), an RGB 
 # image would have 3. A convolutional net can work with multiple-
 # channel input images, but needs the number of channels to be 
 # explicitly stated, hence the final 1 in the tensor shape.
+# (Or a shape of (N,1,28,28), channel first, on older GPUs.)
 # 
 # (This is because the Keras "Conv2D" layer expects 4-tensors 
 #  as inputs.)
 # 
-# The labels also need to be converted to categorical form.
-
-training_images = (training_inputs.astype('float32')/255)[:,:,:,np.newaxis]  # Normalised float32 4-tensor.
-
-categorical_training_outputs = to_categorical(training_labels)
-
-testing_images = (testing_inputs.astype('float32')/255)[:,:,:,np.newaxis]
-
-categorical_testing_outputs = to_categorical(testing_labels)
-print(training_images.shape,training_images.dtype)
+# The labels are left as integer class indices (no one hot encoding);
+# the sparse form of the loss works on them directly.
+#
+# The training set goes through a tf.data pipeline: the uint8 images are
+# given their channel axis once on the first epoch and cached in memory,
+# and the cache is reshuffled and batched on every epoch.  The last SPLIT
+# of the samples is held back for validation, as Keras' validation_split
+# would do.
+#
+# The pipeline reads the training set from a TFRecord file of uint8 images
+# and int64 labels.  It is written on the first run only; later runs (and
+# sharded, multi-host readers) stream straight from it.  The file name
+# carries the number of images, and the file is written under a temporary
+# name and only renamed once complete, so an interrupted first run never
+# leaves a truncated record behind to be trusted by the next one.
+
+record_file = RECORD.format(len(training_inputs))
+if not os.path.exists(record_file):
+    with tensorflow.io.TFRecordWriter(record_file + '.tmp') as writer:
+        for image, label in zip(training_inputs, training_labels):
+            example = tensorflow.train.Example(features=tensorflow.train.Features(feature={
+                'image': tensorflow.train.Feature(
+                    bytes_list=tensorflow.train.BytesList(value=[image.tobytes()])),
+                'label': tensorflow.train.Feature(
+                    int64_list=tensorflow.train.Int64List(value=[int(label)]))}))
+            writer.write(example.SerializeToString())
+    os.replace(record_file + '.tmp', record_file)
+
+FEATURES = {'image': tensorflow.io.FixedLenFeature([], tensorflow.string),
+            'label': tensorflow.io.FixedLenFeature([], tensorflow.int64)}
+
+def parse(record):
+    # Serialised Example --> uint8 (28,28) image and its int32 label.
+    features = tensorflow.io.parse_single_example(record, FEATURES)
+    image = tensorflow.reshape(tensorflow.io.decode_raw(features['image'], tensorflow.uint8), (28,28))
+    return image, tensorflow.cast(features['label'], tensorflow.int32)
+
+def add_channel(image, label):
+    # uint8 (28,28) image --> uint8 (28,28,1) or (1,28,28) tensor.
+    return tensorflow.expand_dims(image, 0 if channels_first else -1), label
+
+n_train = int(len(training_inputs)*(1 - SPLIT))
+n_val = len(training_inputs) - n_train
+
+# A TFRecord file's length is unknown to tf.data, but this one holds
+# exactly len(training_inputs) examples (its name says so), so the size of
+# each split is asserted to keep the batch counts known to Keras.
+records = tensorflow.data.TFRecordDataset([record_file], num_parallel_reads=tensorflow.data.AUTOTUNE)
+
+train_ds = (records.take(n_train)
+            .apply(tensorflow.data.experimental.assert_cardinality(n_train))
+            .map(parse, num_parallel_calls=tensorflow.data.AUTOTUNE)
+            .map(add_channel, num_parallel_calls=tensorflow.data.AUTOTUNE)
+            .cache())
+if SHUFFLE:
+    train_ds = train_ds.shuffle(n_train)
+# model.fit runs under the distribution strategy, whose iterator copies
+# each batch onto the replica GPU(s) ahead of the step that uses it.
+train_ds = train_ds.batch(global_batch).prefetch(tensorflow.data.AUTOTUNE)
+
+val_ds = (records.skip(n_train)
+          .apply(tensorflow.data.experimental.assert_cardinality(n_val))
+          .map(parse, num_parallel_calls=tensorflow.data.AUTOTUNE)
+          .map(add_channel, num_parallel_calls=tensorflow.data.AUTOTUNE)
+          .cache()
+          .batch(global_batch)
+          .prefetch(tensorflow.data.AUTOTUNE))
+
+testing_images = np.expand_dims(testing_inputs, CHANNEL_AXIS)
+print(train_ds.element_spec)
 print(testing_images.shape,testing_images.dtype)
-print(categorical_training_outputs.shape, training_labels.shape)
-print(categorical_testing_outputs.shape, testing_labels.shape)
+print(training_labels.shape, training_labels.dtype)
+print(testing_labels.shape, testing_labels.dtype)
 
+# Preview the first 20 training images as one 2 x 10 mosaic (a single
+# image artist), with their labels row by row in the title.
+mosaic = np.concatenate([np.concatenate(training_inputs[r*10:(r+1)*10], axis=1)
+                         for r in range(2)], axis=0)
 plt.figure(figsize=(14,4))
-for i in range(20):
-    plt.subplot(2,10,i+1)
-    plt.imshow(training_images[i,:,:,0],cmap='gray')
-    plt.title(str(training_labels[i]))
-    plt.axis('off')
+plt.imshow(mosaic,cmap='gray')
+plt.title('   |   '.join(' '.join(str(l) for l in training_labels[r*10:(r+1)*10])
+                          for r in range(2)))
+plt.axis('off')
 
 # Create a Keras model for a net.
 # 
-# It has six convolutional layers and two maxpooling 
-# layers.  The net is then flattened and capped with two dense 
+# It has nine convolutional layers and two maxpooling layers: 
+# a full 3 x 3 stem conv, three depthwise-separable 3 x 3 convs 
+# (each a 3 x 3 depthwise conv over each channel, then a 1 x 1 
+# pointwise conv to mix the channels) and two full 5 x 5 convs.  
+# The separable convs give the same feature map sizes as full 
+# 3 x 3 convs for (9 + k)/(9k) of the multiply-adds with k output 
+# channels, i.e. about 1/7 (k=32) to 1/8 (k=64).  The net is then 
+# flattened (3 x 3 x 64 = 576 values) and capped with two dense 
 # layers.
 # 
 # Stride on the convolutional layer is implicitly 1.
@@ -115,47 +234,69 @@ for i in range(20):
 # essentially a standard hidden+ouput backprop net for 
 # classification.
 #
+# Each convolution is followed by batch normalisation and then the relu,
+# so cuDNN/Grappler can fuse conv+batch-norm+relu into one kernel (and the
+# batch norm can be folded into the conv weights for inference).
+#
+
+# Mixed precision: on Ampere (compute capability 8.0) or newer the conv/dense
+# layers compute in bfloat16 on the tensor cores while their weights are
+# kept in float32.  bfloat16 has the same exponent range as float32, so
+# unlike float16 no loss scaling is needed.  Older GPUs and the CPU stay
+# in plain float32.  The output layer and softmax are always float32 so
+# the loss stays numerically stable.
+if compute_capability >= (8, 0):
+    mixed_precision.set_global_policy('mixed_bfloat16')
 
 # Creating a Keras model for a net. 
-model = Sequential([
-                    Conv2D(32, kernel_size=3, padding='same', 
-                    input_shape= training_images.shape[1:]),
-                    Activation('relu'),
-                    BatchNormalization(),
-
-                    Conv2D(32,kernel_size=3),
-                    Activation('relu'),
-                    BatchNormalization(),
-
-                    Conv2D(32,kernel_size=5),
-                    Activation('relu'),
-                    MaxPooling2D(pool_size=(2,2), strides=(2,2)), # Dimensionality reduction of the inputs
-                    BatchNormalization(),
-                    Dropout(0.4),
-
-                    Conv2D(64,kernel_size=3),
-                    Activation('relu'),
-                    BatchNormalization(),
-
-                    Conv2D(64,kernel_size=3),
-                    Activation('relu'),
-                    BatchNormalization(),
-
-                    Conv2D(64, kernel_size=5, padding='same'), 
-                    Activation('relu'),
-                    BatchNormalization(),
-                    MaxPooling2D(pool_size=(2,2), strides=(2,2)),
-                    Dropout(0.4),
-
-                    Flatten(),
-                    Dense(128),
-                    Activation('relu'),
-                    BatchNormalization(),
-                    Dropout(0.4),
-                    BatchNormalization(),
-                    Dense(10),            # 10 neuron units to predict 0-9 numbers 
-                    Activation('softmax') # For output nonlinearity 
-                ])
+with strategy.scope():
+    model = Sequential([
+                        Rescaling(1./255, input_shape= testing_images.shape[1:]), # uint8 --> [0,1]
+                        Conv2D(32, kernel_size=3, padding='same'),
+                        BatchNormalization(axis=CHANNEL_AXIS),
+                        Activation('relu'),
+
+                        DepthwiseConv2D(kernel_size=3),
+                        BatchNormalization(axis=CHANNEL_AXIS),
+                        Activation('relu'),
+                        Conv2D(32,kernel_size=1),
+                        BatchNormalization(axis=CHANNEL_AXIS),
+                        Activation('relu'),
+
+                        Conv2D(32,kernel_size=5),
+                        BatchNormalization(axis=CHANNEL_AXIS),
+                        Activation('relu'),
+                        MaxPooling2D(pool_size=(2,2), strides=(2,2)), # Dimensionality reduction of the inputs
+                        Dropout(0.4),
+
+                        DepthwiseConv2D(kernel_size=3),
+                        BatchNormalization(axis=CHANNEL_AXIS),
+                        Activation('relu'),
+                        Conv2D(64,kernel_size=1),
+                        BatchNormalization(axis=CHANNEL_AXIS),
+                        Activation('relu'),
+
+                        DepthwiseConv2D(kernel_size=3),
+                        BatchNormalization(axis=CHANNEL_AXIS),
+                        Activation('relu'),
+                        Conv2D(64,kernel_size=1),
+                        BatchNormalization(axis=CHANNEL_AXIS),
+                        Activation('relu'),
+
+                        Conv2D(64, kernel_size=5, padding='same'), 
+                        BatchNormalization(axis=CHANNEL_AXIS),
+                        Activation('relu'),
+                        MaxPooling2D(pool_size=(2,2), strides=(2,2)),
+                        Dropout(0.4),
+
+                        Flatten(),
+                        Dense(128),
+                        BatchNormalization(),
+                        Activation('relu'),
+                        Dropout(0.4),
+                        Dense(10, dtype='float32'),            # 10 neuron units to predict 0-9 numbers 
+                        Activation('softmax', dtype='float32') # For output nonlinearity 
+                    ])
 
 ## An overfitted model "memorizes" the noise and details in the training dataset 
 ## to a point where it negatively impacts the performance of the model on new data. 
@@ -163,6 +304,14 @@ model = Sequential([
 ## but the real challenge is generalization, not fitting.
 ##
 
+# On Hopper (compute capability 9.0) GPUs, Keras 3 can run the two Dense
+# layers as float8 matmuls.  Only Dense layers are quantized; the convs are
+# untouched.  Older GPUs, the CPU and Keras 2 (no model.quantize) skip this.
+if (tensorflow.test.is_built_with_cuda() and compute_capability >= (9, 0)
+        and hasattr(model, 'quantize')):
+    with strategy.scope():
+        model.quantize('float8')
+
 
 # Review the network.
 
@@ -175,48 +324,46 @@ model.summary()
 # function.
 # 
 # Here, because we have a convolutional network model, Log-Loss is a good 
-# metric.  In Keras this is called "categorical_crossentropy".  And, if 
+# metric.  In Keras this is called "categorical_crossentropy", or
+# "sparse_categorical_crossentropy" for integer labels.  And, if 
 # using Log-Loss, we really need an adaptive gradient algorithm, here 
 # I've used ADAM, which is a good, reliable 
 # adaptive algoithm.  My metric is accuracy 
 # on the validation set, but I'm also interested in monitoring training
 # accuracy and training/validation loss.
 # 
+# The train step is compiled with XLA, which fuses each conv/relu/
+# batch-norm chain into fewer kernels and saves memory round trips.
+# Adam's per-variable updates are part of that compiled train step, so
+# they are fused by XLA too.
+# STEPS batches are run per call into the compiled graph, rather than
+# returning to Python after every batch; callbacks such as early
+# stopping still run at the end of each epoch.  This needs datasets of
+# known size (hence the assert_cardinality on the TFRecord splits):
+# Keras 2 refuses to fit otherwise, and Keras 3 miscounts the steps.
 
 #model compilation
-model.compile(loss='categorical_crossentropy', optimizer=OPT, metrics=['accuracy'])
+with strategy.scope():
+    opt = optimizers.Adam(learning_rate=LR*replicas)
+    model.compile(loss='sparse_categorical_crossentropy', optimizer=opt, metrics=['accuracy'],
+                  jit_compile=True, steps_per_execution=STEPS)
 
 from tensorflow.keras.callbacks import EarlyStopping
 
-stop = EarlyStopping(monitor='val_loss', min_delta=0, patience=3, 
+stop = EarlyStopping(monitor='val_loss', min_delta=0, patience=PATIENCE, 
                      verbose=2, mode='auto',
                      restore_best_weights=True)
 
 
-history = model.fit(training_images, categorical_training_outputs,
+history = model.fit(train_ds,
                     epochs=EPOCHS, 
-                    batch_size=BATCH, 
-                    shuffle=SHUFFLE, 
-                    validation_split=SPLIT,
+                    validation_data=val_ds,
                     verbose=2, 
                     callbacks=[stop])
 
 
-# Graphing the training and validation loss for each epoch
-
-plt.figure('Training and Validation Losses per epoch', figsize=(8,8))
-
-plt.plot(history.history['loss'],label='training') # Training data error per epoch.
-
-plt.plot(history.history['val_loss'],label='validation') # Validation error per ep.
-
-plt.grid(True)
-
-plt.legend()
-
-plt.xlabel('Epoch Number')
-plt.ylabel('Loss')
-plt.show()
+# Graphing the training and validation loss and accuracy for each epoch,
+# in one figure.
 
 model_history = history.history
 print(model_history.keys())
@@ -227,30 +374,30 @@ validation_loss = model_history['val_loss']
 model_accu = model_history['accuracy']
 epochs = range(len(model_accu))
 
-#plot of Validation Accuracy and Training Accuracy
-plt.figure(figsize = (14,10))
-plt.subplot(211)
-plt.plot(epochs, validation_accuracy, 'bo', label = 'Validation Accuracy')
-plt.plot(epochs, model_accu, 'orange', label = 'Training Accuracy') 
-plt.xlabel('Epochs')
-plt.ylabel('Accuracy')         
-plt.legend()
-         
+fig, (ax_loss, ax_acc) = plt.subplots(2, 1, figsize=(10,10))
+fig.suptitle('Training and Validation Loss / Accuracy per epoch')
+
 #plot of Validation Loss and Training Loss
-plt.figure(figsize = (14,10))
-plt.subplot(212)
-plt.plot(epochs, validation_loss, 'bo', label = 'Validation Loss')         
-plt.plot(epochs, model_loss,'orange', label = 'Training Loss')         
-plt.xlabel('Epochs')
-plt.ylabel('Loss')         
-plt.legend()
+ax_loss.plot(epochs, validation_loss, 'bo', label = 'Validation Loss')
+ax_loss.plot(epochs, model_loss,'orange', label = 'Training Loss')
+ax_loss.set_xlabel('Epochs')
+ax_loss.set_ylabel('Loss')
+ax_loss.grid(True)
+ax_loss.legend()
+
+#plot of Validation Accuracy and Training Accuracy
+ax_acc.plot(epochs, validation_accuracy, 'bo', label = 'Validation Accuracy')
+ax_acc.plot(epochs, model_accu, 'orange', label = 'Training Accuracy')
+ax_acc.set_xlabel('Epochs')
+ax_acc.set_ylabel('Accuracy')
+ax_acc.legend()
 
 plt.show()
 
 # Comparing the model with an unseen/used dataset
 
 print("Performance of network on testing set:")
-test_loss,test_acc = model.evaluate(testing_images,categorical_testing_outputs)
+test_loss,test_acc = model.evaluate(testing_images,testing_labels)
 print("Accuracy on testing data: {:6.2f}%".format(test_acc*100))
 print("Test error (loss):        {:8.4f}".format(test_loss))
 print("")